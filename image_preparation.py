@@ -124,6 +124,7 @@ def list_filepaths(dir, patterns_in, patterns_out, include_all_patterns=True, pr
 
 ##############################################################################################################
 # reproject LST and IMD to 3857/4326
+# Not needed for the analysis anymore: read_image reprojects the 3035 masters on the fly (see modules/images.py).
 ##############################################################################################################
 
 # # target_res = 70
@@ -173,9 +174,11 @@ def list_filepaths(dir, patterns_in, patterns_out, include_all_patterns=True, pr
 
 ##############################################################################################################
 # cut LST and IMD to shp regions
+# Optional: read_image can also read any region on demand from the national rasters (shapefiles_dir / bbox).
 ##############################################################################################################
 
-target_proj = 'EPSG:4326'
+# clip in the master projection only, other projections are derived on the fly by read_image
+target_proj = 'EPSG:3035'
 target_res = 70
 
   
@@ -1,17 +1,98 @@
 import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
 import numpy as np  
 from scipy.ndimage import zoom
+from scipy.stats import norm as normal_distribution
+from concurrent.futures import ThreadPoolExecutor
 import folium
 import os
+from affine import Affine
+from rasterio.transform import array_bounds, from_bounds as transform_from_bounds
 
 from modules.regions_dict import regions_dict
-from modules.images import read_image, save_as_png
+from modules.images import read_image, save_as_png, find_dataset_path, resolve_dataset_path
 from modules.utils import define_colormap
+from modules.cache import cached_product, default_cache_dir, default_max_cache_size_mb
+from modules.overlays import ValueEncodedImageOverlay, ClientSideMaskControl
+from modules.multilayer import iter_joint_windows
 
-def calculate_statistics(rasters_dir, chosen_region, label, exclude_values=[]):
+
+# runs the exact computations requested with refine=True in the background
+_refine_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def sample_statistics(sample, confidence=0.95):
+    
+    '''Statistics of a pixel sample (as in calculate_statistics), with approximate confidence intervals
+    for the mean (normal approximation) and the median and 90th percentile (order statistics).
+    NaN values are ignored. An empty sample gives NaN statistics, a sample of one pixel a NaN interval for the mean.
+    '''
+    
+    sample = np.sort(sample[~np.isnan(sample)].flatten())
+    n = len(sample)
+    z = normal_distribution.ppf(0.5 + confidence / 2)
+    
+    if n == 0:
+        print('Warning! No valid pixels found in the sample.')
+        return {
+            'mean': np.nan,
+            'median': np.nan,
+            'percentile_90': np.nan,
+            'min': np.nan,
+            'max': np.nan,
+            'n_samples': 0,
+            'confidence_intervals': {key: (np.nan, np.nan) for key in ['mean', 'median', 'percentile_90']}
+        }
+    
+    def quantile_interval(q):
+        half_width = z * np.sqrt(n * q * (1 - q))
+        return sample[max(int(np.floor(n*q - half_width)), 0)], sample[min(int(np.ceil(n*q + half_width)), n - 1)]
+    
+    mean_val = np.mean(sample)
+    mean_half_width = z * np.std(sample, ddof=1) / np.sqrt(n) if n > 1 else np.nan
     
-    output = read_image(rasters_dir, chosen_region, label)
+    output = {
+        'mean': mean_val,
+        'median': np.median(sample),
+        'percentile_90': np.percentile(sample, 90),
+        'min': sample[0],
+        'max': sample[-1],
+        'n_samples': n,
+        'confidence_intervals': {
+            'mean': (mean_val - mean_half_width, mean_val + mean_half_width),
+            'median': quantile_interval(0.5),
+            'percentile_90': quantile_interval(0.9)
+        }
+    }
+    
+    return output
+
+
+def calculate_statistics(rasters_dir, chosen_region, label, exclude_values=[], preview=False, decimation=8, refine=False, confidence=0.95,
+                         shapefiles_dir=None, bbox=None):
+    
+    '''Mean, median, 90th percentile, min and max of the label image of the chosen region.
+    preview: if True, only every decimation-th pixel in both directions is read, and confidence intervals
+    (see sample_statistics) are added. min and max are those of the sample.
+    refine: with preview, the exact statistics are computed in the background; output['exact'] is a
+    concurrent.futures.Future, output['exact'].result() waits for them. Only statistics can be refined,
+    plots are drawn once (plot_histograms and generate_scatter_plot have preview but no refine).
+    shapefiles_dir, bbox: to read the region on demand from the national rasters in rasters_dir (see read_image).
+    '''
+    
+    if preview:
+        output = read_image(rasters_dir, chosen_region, label, decimation=decimation, shapefiles_dir=shapefiles_dir, bbox=bbox)
+        arr = output['array']
+        output = sample_statistics(arr[~np.isin(arr, exclude_values)], confidence)
+        
+        if refine:
+            output['exact'] = _refine_executor.submit(calculate_statistics, rasters_dir, chosen_region, label, exclude_values,
+                                                      shapefiles_dir=shapefiles_dir, bbox=bbox)
+            
+        return output
+    
+    output = read_image(rasters_dir, chosen_region, label, shapefiles_dir=shapefiles_dir, bbox=bbox)
     arr, arr_min, arr_max = output['array'], output['min_value'], output['max_value']
     masked_arr = arr[~np.isin(arr, exclude_values)].flatten()
     
@@ -33,7 +114,13 @@ def calculate_statistics(rasters_dir, chosen_region, label, exclude_values=[]):
     return output
 
 
-def plot_histograms(rasters_dir, chosen_region, histogram_setups, figure_size=(12, 4), log_scale=False):
+def plot_histograms(rasters_dir, chosen_region, histogram_setups, figure_size=(12, 4), log_scale=False, preview=False, decimation=8,
+                    shapefiles_dir=None, bbox=None):
+
+    '''Histograms of the images in histogram_setups.
+    preview: if True, only every decimation-th pixel in both directions is used.
+    shapefiles_dir, bbox: to read the region on demand from the national rasters in rasters_dir (see read_image).
+    '''
 
     fig, axes = plt.subplots(1, len(histogram_setups), figsize=figure_size)
     axes = np.atleast_1d(axes)  # Ensure axes is always an array
@@ -45,7 +132,7 @@ def plot_histograms(rasters_dir, chosen_region, histogram_setups, figure_size=(1
         exclude_values = hist_setup['exclude_values']
         name = hist_setup['layer_name']
 
-        output = read_image(rasters_dir, chosen_region, label)
+        output = read_image(rasters_dir, chosen_region, label, decimation=decimation if preview else 1, shapefiles_dir=shapefiles_dir, bbox=bbox)
         arr, arr_min, arr_max = output['array'], output['min_value'], output['max_value']
 
         # Normalize the data for color mapping
@@ -63,7 +150,7 @@ def plot_histograms(rasters_dir, chosen_region, histogram_setups, figure_size=(1
             axes[i].bar(edge, count, width=(bins[1] - bins[0]), color=cmap(norm(edge)), edgecolor='black', alpha=0.7)
 
         axes[i].set_xlabel(name)
-        axes[i].set_ylabel('Frequency')
+        axes[i].set_ylabel(f'Frequency (1 in {decimation**2} pixels)' if preview else 'Frequency')
         axes[i].grid(True, which='both', linestyle='--', linewidth=0.5)
         axes[i].set_axisbelow(True)
 
@@ -76,10 +163,10 @@ def plot_histograms(rasters_dir, chosen_region, histogram_setups, figure_size=(1
 
 
 
-def match_array_shape(imd_arr, lst_arr, scaling_factor=7):
+def match_array_shape(imd_arr, lst_arr, scaling_factor=7, order=1):
 
     '''bring the arrays to the same shape.
-    Resamples IMD, repeats LST.
+    Resamples IMD (spline interpolation of the given order), repeats LST.
     '''
 
     # resize IMD to shape divisible by scaling_factor
@@ -87,7 +174,11 @@ def match_array_shape(imd_arr, lst_arr, scaling_factor=7):
 
     # Resample imd_window to 7*lst_arr.shape[0] x 7*lst_arr.shape[1]
     # order=1 for bilinear interpolation
-    imd_arr_reshaped = zoom(imd_arr, zoom_factors, order=1) 
+    if zoom_factors == (1, 1):
+        # already on the LST grid (see read_aligned_pair), zoom would only spread NaNs
+        imd_arr_reshaped = imd_arr.copy()
+    else:
+        imd_arr_reshaped = zoom(imd_arr, zoom_factors, order=order) 
     
     # convert to int
     imd_arr_reshaped[np.isnan(imd_arr_reshaped)] = 255 
@@ -104,23 +195,129 @@ def match_array_shape(imd_arr, lst_arr, scaling_factor=7):
     return imd_arr_reshaped, lst_arr_reshaped
 
 
+def _source_paths(rasters_dir, chosen_region, shapefiles_dir=None, bbox=None):
+
+    # files an aligned pair is derived from (part of the cache key)
+    paths = [resolve_dataset_path(rasters_dir, chosen_region, label, shapefiles_dir, bbox) for label in ('IMD', 'LST')]
+    if bbox is None and shapefiles_dir is not None:
+        paths.append(os.path.join(shapefiles_dir, regions_dict[chosen_region][2]))
+
+    return paths
+
+
+# warp resampling of IMD for each interpolation order (as in scipy.ndimage.zoom)
+order_resampling = {0: 'nearest', 1: 'bilinear', 3: 'cubic'}
+
+
+def read_aligned_pair(rasters_dir, chosen_region, scaling_factor=7, order=1, decimation=1, shapefiles_dir=None, bbox=None):
+
+    '''Read LST, and IMD warped onto the LST grid refined by scaling_factor, so that both cover exactly
+    the same area, then bring them to the same shape (see match_array_shape).
+    order: interpolation of IMD, 0 (nearest), 1 (bilinear) or 3 (cubic).
+    decimation: passed to read_image for LST (IMD follows the decimated LST grid).
+    shapefiles_dir, bbox: to read the region on demand from the national rasters in rasters_dir (see read_image).
+    Return the aligned IMD and LST arrays and the read_image output of LST.
+    '''
+
+    if order not in order_resampling:
+        raise ValueError(f'Invalid order argument. Choose from {list(order_resampling)}.')
+
+    lst_output = read_image(rasters_dir, chosen_region, 'LST', decimation=decimation, shapefiles_dir=shapefiles_dir, bbox=bbox)
+    lst_arr = lst_output['array']
+
+    imd_grid = (lst_output['transform'] * Affine.scale(1 / scaling_factor), lst_arr.shape[1] * scaling_factor, lst_arr.shape[0] * scaling_factor)
+    imd_output = read_image(rasters_dir, chosen_region, 'IMD', reference_grid=imd_grid, resampling=order_resampling[order], shapefiles_dir=shapefiles_dir, bbox=bbox)
+
+    imd_arr, lst_arr = match_array_shape(imd_output['array'], lst_arr, scaling_factor, order)
+
+    return imd_arr, lst_arr, lst_output
+
+
+def load_aligned_pair(rasters_dir, chosen_region, scaling_factor=7, order=1, use_cache=True, cache_dir=default_cache_dir,
+                      shapefiles_dir=None, bbox=None, max_cache_size_mb=default_max_cache_size_mb):
+
+    '''Read IMD and LST for the chosen region and bring them to the same shape (see match_array_shape).
+    If use_cache is True, the aligned pair is stored in cache_dir and loaded from there on the next call
+    (also after a kernel restart or from another process), as long as the source rasters and parameters are unchanged.
+    max_cache_size_mb: size of cache_dir above which the least recently used products are deleted (see cached_product).
+    shapefiles_dir, bbox: to read the region on demand from the national rasters in rasters_dir (see read_image).
+    Return a dict with 'IMD' and 'LST' (LazyArray if cached, else numpy arrays) and the LST 'bounds'.
+    '''
+
+    source_paths = _source_paths(rasters_dir, chosen_region, shapefiles_dir, bbox)
+
+    def build():
+        imd_arr, lst_arr, lst_output = read_aligned_pair(rasters_dir, chosen_region, scaling_factor, order, shapefiles_dir=shapefiles_dir, bbox=bbox)
+        (bottom, left), (top, right) = lst_output['bounds']
+        transform = transform_from_bounds(left, bottom, right, top, lst_arr.shape[1], lst_arr.shape[0])
+        bands = {'IMD': imd_arr.astype(np.float32), 'LST': lst_arr.astype(np.float32)}
+        return bands, {'crs': lst_output['crs'], 'transform': transform, 'nodata': np.nan}
+
+    if not use_cache:
+        bands, profile = build()
+    else:
+        params = {'product': 'aligned_pair', 'alignment': 'lst_grid', 'scaling_factor': scaling_factor, 'order': order, 'bbox': bbox}
+        bands = cached_product(f'aligned_{chosen_region}', source_paths, params, build, cache_dir=cache_dir, max_cache_size_mb=max_cache_size_mb)
+        profile = bands['profile']
+
+    left, bottom, right, top = array_bounds(bands['LST'].shape[0], bands['LST'].shape[1], profile['transform'])
+
+    return {'IMD': bands['IMD'], 'LST': bands['LST'], 'bounds': [[bottom, left], [top, right]]}
+
+
+def load_mask(rasters_dir, chosen_region, mask_by, mask_below, scaling_factor=7, order=1, use_cache=True, cache_dir=default_cache_dir,
+              shapefiles_dir=None, bbox=None, max_cache_size_mb=default_max_cache_size_mb):
+
+    '''Mask of the aligned pair (see load_aligned_pair): True where mask_by ('LST' or 'IMD') is below mask_below
+    (for IMD also where there is no data). Cached in cache_dir like the aligned pair if use_cache is True.
+    Return a boolean array.
+    '''
+
+    if mask_by not in ('LST', 'IMD'):
+        raise ValueError('Invalid mask_by argument. Choose from "LST" or "IMD".')
+
+    source_paths = _source_paths(rasters_dir, chosen_region, shapefiles_dir, bbox)
+
+    def build():
+        pair = load_aligned_pair(rasters_dir, chosen_region, scaling_factor, order, use_cache, cache_dir, shapefiles_dir=shapefiles_dir, bbox=bbox,
+                                 max_cache_size_mb=max_cache_size_mb)
+        if mask_by == 'LST':
+            mask = np.asarray(pair['LST']) < mask_below
+        else:
+            imd_arr = np.asarray(pair['IMD'])
+            mask = (imd_arr < mask_below) | np.isnan(imd_arr) | (imd_arr == 255)
+        return {'mask': mask.astype(np.uint8)}, {}
+
+    if not use_cache:
+        return build()[0]['mask'].astype(bool)
+
+    params = {'product': 'mask', 'alignment': 'lst_grid', 'scaling_factor': scaling_factor, 'order': order, 'mask_by': mask_by, 'mask_below': mask_below,
+              'bbox': bbox}
+    product = cached_product(f'mask_{chosen_region}', source_paths, params, build, cache_dir=cache_dir, max_cache_size_mb=max_cache_size_mb)
+
+    return np.asarray(product['mask']).astype(bool)
+
+
 
     
-def generate_scatter_plot(rasters_dir, chosen_region, imd_layer_name, lst_layer_name, filter_outliers=True, exclude_values=[0,100], log_scale=False):
+def generate_scatter_plot(rasters_dir, chosen_region, imd_layer_name, lst_layer_name, filter_outliers=True, exclude_values=[0,100], log_scale=False,
+                          use_cache=True, preview=False, decimation=8, shapefiles_dir=None, bbox=None):
+
+    '''Scatter plot of the mean LST per IMD value.
+    preview: if True, only every decimation-th pixel in both directions of IMD and LST is used (the cache is not used).
+    shapefiles_dir, bbox: to read the region on demand from the national rasters in rasters_dir (see read_image).
+    '''
 
     # Initialize lists to store IMD values and corresponding mean LST values
     imd_values = []
     lst_mean_values = []
 
 
-    output = read_image(rasters_dir, chosen_region, 'IMD')
-    imd_arr, imd_arr_min, imd_arr_max = output['array'], output['min_value'], output['max_value']
-
-    output = read_image(rasters_dir, chosen_region, 'LST')
-    lst_arr, lst_arr_min, lst_arr_max = output['array'], output['min_value'], output['max_value']
-
-
-    imd_arr, lst_arr = match_array_shape(imd_arr, lst_arr, scaling_factor=7)
+    if preview:
+        imd_arr, lst_arr, _ = read_aligned_pair(rasters_dir, chosen_region, scaling_factor=7, decimation=decimation, shapefiles_dir=shapefiles_dir, bbox=bbox)
+    else:
+        pair = load_aligned_pair(rasters_dir, chosen_region, scaling_factor=7, use_cache=use_cache, shapefiles_dir=shapefiles_dir, bbox=bbox)
+        imd_arr, lst_arr = np.asarray(pair['IMD']), np.asarray(pair['LST'])
     # print(imd_arr.shape, lst_arr.shape)
     # np.unique(imd_arr)
 
@@ -188,6 +385,133 @@ def generate_scatter_plot(rasters_dir, chosen_region, imd_layer_name, lst_layer_
     plt.close()
     
     
+def iter_aligned_windows(imd_path, lst_path, scaling_factor=7, block_rows=64):
+
+    '''Iterate over the LST raster in strips of block_rows rows and yield aligned (imd_block, lst_block) pairs.
+    Both are read with iter_joint_windows on the LST grid refined by scaling_factor: IMD resampled (bilinear)
+    and truncated to integer classes, LST repeated on both axes, i.e. the same alignment as match_array_shape,
+    but only one strip is held in memory at a time. Nodata is returned as NaN in both blocks.
+    '''
+
+    for blocks in iter_joint_windows(None, None, ['IMD', 'LST'], reference='LST', block_rows=block_rows,
+                                     scaling_factor=scaling_factor, paths={'IMD': imd_path, 'LST': lst_path}):
+        yield np.floor(blocks['IMD']), blocks['LST']
+
+
+def joint_histogram(rasters_dir, chosen_region, lst_bin_edges=None, scaling_factor=7, block_rows=64):
+
+    '''2D histogram of IMD class (0-100) x LST bin, accumulated block by block over aligned windows.
+    Memory is fixed by the bin grid, not by the size of the region.
+    lst_bin_edges: LST bin edges (default: 0.25 degree bins from -20 to 60). LST values outside are ignored.
+    Return a dict with 'counts' (IMD classes x LST bins), 'imd_classes' and 'lst_bin_edges'.
+    '''
+
+    if lst_bin_edges is None:
+        lst_bin_edges = np.arange(-20, 60.25, 0.25)
+    lst_bin_edges = np.asarray(lst_bin_edges, dtype=float)
+
+    imd_classes = np.arange(101)
+    n_lst_bins = len(lst_bin_edges) - 1
+    counts = np.zeros((len(imd_classes), n_lst_bins), dtype=np.int64)
+
+    imd_path = find_dataset_path(rasters_dir, chosen_region, 'IMD')
+    lst_path = find_dataset_path(rasters_dir, chosen_region, 'LST')
+
+    for imd_block, lst_block in iter_aligned_windows(imd_path, lst_path, scaling_factor, block_rows):
+
+        valid = ~np.isnan(imd_block) & ~np.isnan(lst_block)
+        imd_idx = imd_block[valid].astype(int)
+        lst_idx = np.searchsorted(lst_bin_edges, lst_block[valid], side='right') - 1
+
+        # include the right-most edge in the last bin (as np.histogram does)
+        lst_idx[lst_block[valid] == lst_bin_edges[-1]] = n_lst_bins - 1
+
+        in_range = (imd_idx >= 0) & (imd_idx < len(imd_classes)) & (lst_idx >= 0) & (lst_idx < n_lst_bins)
+
+        # merge the partial counts of this block
+        counts += np.bincount(imd_idx[in_range]*n_lst_bins + lst_idx[in_range], minlength=counts.size).reshape(counts.shape)
+
+    return {'counts': counts, 'imd_classes': imd_classes, 'lst_bin_edges': lst_bin_edges}
+
+
+def joint_histogram_quantiles(hist, quantiles=(0.1, 0.5, 0.9)):
+
+    '''Per IMD class LST quantiles from a joint histogram (output of joint_histogram).
+    Values are linearly interpolated within LST bins.
+    Return an array of shape (IMD classes, quantiles), NaN for classes without pixels.
+    '''
+
+    counts, edges = hist['counts'], hist['lst_bin_edges']
+
+    cumulative = np.cumsum(counts, axis=1)
+    totals = cumulative[:, -1]
+
+    output = np.full((counts.shape[0], len(quantiles)), np.nan)
+
+    for c in np.flatnonzero(totals):
+        for j, q in enumerate(quantiles):
+
+            target = q * totals[c]
+            # for q = 0 start at the first non-empty bin, not at the empty bins before it
+            b = min(np.searchsorted(cumulative[c], target, side='right' if target == 0 else 'left'), counts.shape[1] - 1)
+            below = cumulative[c, b] - counts[c, b]
+            fraction = (target - below) / counts[c, b] if counts[c, b] > 0 else 0
+
+            output[c, j] = edges[b] + fraction * (edges[b+1] - edges[b])
+
+    return output
+
+
+def generate_density_plot(rasters_dir, chosen_region, imd_layer_name, lst_layer_name, quantiles=(0.1, 0.5, 0.9),
+                          exclude_values=[], lst_bin_edges=None, scaling_factor=7):
+
+    '''Density plot of the joint IMD x LST histogram with per IMD class quantile bands.
+    Unlike generate_scatter_plot, the whole distribution is kept, and the data is processed in a single streaming pass.
+    quantiles: the outer two values define the band, the middle value (if any) is drawn as a line.
+    exclude_values: IMD classes to leave out of the plot (e.g. [0, 100]).
+    Return the joint histogram dict (see joint_histogram), with the quantiles added under 'quantiles'.
+    '''
+
+    hist = joint_histogram(rasters_dir, chosen_region, lst_bin_edges=lst_bin_edges, scaling_factor=scaling_factor)
+    hist['quantiles'] = joint_histogram_quantiles(hist, quantiles)
+
+    counts = hist['counts'].astype(float)
+    counts[np.isin(hist['imd_classes'], exclude_values)] = 0
+    quantile_values = hist['quantiles'].copy()
+    quantile_values[np.isin(hist['imd_classes'], exclude_values)] = np.nan
+
+    # restrict the LST axis to bins that contain data
+    filled_bins = np.flatnonzero(counts.sum(axis=0))
+    if len(filled_bins) == 0:
+        print('Warning! No valid pixels found for the chosen region.')
+        return hist
+    edges = hist['lst_bin_edges']
+    first, last = filled_bins[0], filled_bins[-1] + 1
+
+    imd_edges = np.append(hist['imd_classes'], hist['imd_classes'][-1] + 1) - 0.5
+    counts[counts == 0] = np.nan
+
+    plt.figure(figsize=(8, 6))
+    mesh = plt.pcolormesh(imd_edges, edges[first:last+1], counts[:, first:last].T, cmap='Spectral_r', norm=LogNorm())
+    plt.colorbar(mesh, label='Pixel count')
+
+    plt.fill_between(hist['imd_classes'], quantile_values[:, 0], quantile_values[:, -1], color='black', alpha=0.2,
+                     label=f'{quantiles[0]:.0%} - {quantiles[-1]:.0%} quantile')
+    if len(quantiles) > 2:
+        middle = len(quantiles) // 2
+        plt.plot(hist['imd_classes'], quantile_values[:, middle], color='black', linewidth=2, label=f'{quantiles[middle]:.0%} quantile')
+
+    plt.xlabel(imd_layer_name)
+    plt.ylabel(lst_layer_name)
+    plt.legend()
+    plt.grid(True, which='both', linestyle='--', linewidth=0.5)
+
+    plt.show()
+    plt.close()
+
+    return hist
+
+
 def calculate_statistics_masked(arr, exclude_values):
     
     masked_arr = arr[~np.isin(arr, exclude_values)].flatten()
@@ -199,12 +523,29 @@ def calculate_statistics_masked(arr, exclude_values):
     return mean_val, median_val, percentile_90_val
 
 
+def print_masked_statistics(imd_arr, lst_arr, imd_layer_name, lst_layer_name):
+    
+    imd_stats=calculate_statistics_masked(imd_arr, [0])
+    lst_stats=calculate_statistics_masked(lst_arr, [])
+    
+    print(f"{imd_layer_name}\nMean: {imd_stats[0]:.2f}, Median: {imd_stats[1]:.2f}, 90th Percentile: {imd_stats[2]:.2f}\n")
+    print(f"{lst_layer_name}\nMean: {lst_stats[0]:.2f}, Median: {lst_stats[1]:.2f}, 90th Percentile: {lst_stats[2]:.2f}")
+
+
+
 
 
 
 
+def analyze_masked_area(rasters_dir, chosen_region, mask_below, clim, imd_layer_name, lst_layer_name, mask_by='LST', use_cache=True,
+                        client_side=False, shapefiles_dir=None, bbox=None):
+    
+    '''Show LST and IMD of the area where mask_by is at least mask_below on a map, and print their statistics.
+    client_side: if True, the values are embedded once and the threshold, colormaps and clim can be changed
+    on the map itself (see modules/overlays.py). The printed statistics are for the initial mask_below.
+    shapefiles_dir, bbox: to read the region on demand from the national rasters in rasters_dir (see read_image).
+    '''
 
-def analyze_masked_area(rasters_dir, chosen_region, mask_below, clim, imd_layer_name, lst_layer_name, mask_by='LST'):
     
     
     from folium.plugins import SideBySideLayers
@@ -230,24 +571,34 @@ def analyze_masked_area(rasters_dir, chosen_region, mask_below, clim, imd_layer_
     figure = folium.Figure(width=600, height=400)
     map = folium.Map(coordinates, zoom_start=regions_dict[chosen_region][1], tiles='Cartodb Positron').add_to(figure)
 
-    output = read_image(rasters_dir, chosen_region, 'IMD')
-    imd_arr, imd_arr_min, imd_arr_max = output['array'], output['min_value'], output['max_value']
+    # aligned arrays and mask are loaded from the derived product cache, if available
+    mask = load_mask(rasters_dir, chosen_region, mask_by, mask_below, scaling_factor=7, use_cache=use_cache, shapefiles_dir=shapefiles_dir, bbox=bbox)
 
-    output = read_image(rasters_dir, chosen_region, 'LST')
-    lst_arr, lst_arr_min, lst_arr_max, bounds = output['array'], output['min_value'], output['max_value'], output['bounds']
-
-    imd_arr, lst_arr = match_array_shape(imd_arr, lst_arr, scaling_factor=7)
-
-    if mask_by == 'LST':
-        mask = np.where(lst_arr<mask_below)
-    elif mask_by == 'IMD':
-        mask = (imd_arr < mask_below) | np.isnan(imd_arr) | (imd_arr == 255)
-    else:
-        raise ValueError('Invalid mask_by argument. Choose from "LST" or "IMD".')
+    pair = load_aligned_pair(rasters_dir, chosen_region, scaling_factor=7, use_cache=use_cache, shapefiles_dir=shapefiles_dir, bbox=bbox)
+    imd_arr, lst_arr, bounds = np.array(pair['IMD']), np.array(pair['LST']), pair['bounds']
+    imd_arr_min, imd_arr_max = np.nanmin(imd_arr), np.nanmax(imd_arr)
+        
+    if client_side:
+        # ship the unmasked values once, masking and coloring happen in the browser
+        imd_layer = ValueEncodedImageOverlay(imd_arr, bounds, color_code='Reds', clim=(0,100), value_range=(0,100), name=imd_layer_name, zindex=1)
+        # LST at its own resolution (the aligned LST repeats every value 7 x 7 times), the mask is upsampled in the browser
+        # codes aligned to mask_below, so that the browser masks exactly like load_mask (IMD is encoded without loss)
+        lst_layer = ValueEncodedImageOverlay(lst_arr[::7, ::7], bounds, color_code='Spectral_r', clim=clim, name=lst_layer_name, zindex=1,
+                                             anchor=mask_below if mask_by == 'LST' else None)
+        imd_layer.add_to(map)
+        lst_layer.add_to(map)
+        
+        ClientSideMaskControl([imd_layer, lst_layer], lst_layer if mask_by == 'LST' else imd_layer, mask_below).add_to(map)
+        map.add_child(define_colormap('Spectral_04', clim[0], clim[1], True))
+        folium.LayerControl().add_to(map)
         
     lst_arr[mask] = np.nan
     imd_arr[mask] = np.nan
 
+    if client_side:
+        print_masked_statistics(imd_arr, lst_arr, imd_layer_name, lst_layer_name)
+        return map
+
 
     # plt.imshow(lst_arr, cmap='Spectral_r')
     # plt.clim(clim)
@@ -295,11 +646,7 @@ def analyze_masked_area(rasters_dir, chosen_region, mask_below, clim, imd_layer_
 
     folium.LayerControl().add_to(map)
     
-    imd_stats=calculate_statistics_masked(imd_arr, [0])
-    lst_stats=calculate_statistics_masked(lst_arr, [])
-    
-    print(f"{imd_layer_name}\nMean: {imd_stats[0]:.2f}, Median: {imd_stats[1]:.2f}, 90th Percentile: {imd_stats[2]:.2f}\n")
-    print(f"{lst_layer_name}\nMean: {lst_stats[0]:.2f}, Median: {lst_stats[1]:.2f}, 90th Percentile: {lst_stats[2]:.2f}")
+    print_masked_statistics(imd_arr, lst_arr, imd_layer_name, lst_layer_name)
     
     return map
 
@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import warnings
+import weakref
+from contextlib import contextmanager
+import numpy as np
+import rasterio
+from rasterio.errors import NotGeoreferencedWarning, RasterioIOError
+from rasterio.windows import Window
+
+
+default_cache_dir = 'cache'
+default_max_cache_size_mb = 2048
+
+# temporary files of interrupted writes older than this (in seconds) are deleted by cleanup_cache
+stale_tmp_age = 3600
+
+# LazyArrays in use in this process, their files are never deleted by cleanup_cache
+_live_arrays = weakref.WeakSet()
+
+
+@contextmanager
+def _open_product(path):
+
+    # products without a geotransform (e.g. masks) are fine, do not warn about them
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', NotGeoreferencedWarning)
+        with rasterio.open(path) as src:
+            yield src
+
+
+class LazyArray:
+
+    '''
+    One band of a cached product, read from disk only when accessed.
+    Supports np.asarray(lazy_array) for the whole band and lazy_array[rows, cols] (slices) for a window.
+    The file is kept open while the LazyArray exists, and cleanup_cache does not delete it in the meantime.
+    '''
+
+    def __init__(self, path, band):
+        self.path = path
+        self.band = band
+        self._lock = threading.Lock()  # a dataset must not be read from several threads at once
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', NotGeoreferencedWarning)
+            self._src = rasterio.open(path)
+        self.shape = (self._src.height, self._src.width)
+        self.dtype = np.dtype(self._src.dtypes[band - 1])
+        _live_arrays.add(self)
+        weakref.finalize(self, self._src.close)
+
+    def read(self, window=None):
+        with self._lock:
+            return self._src.read(self.band, window=window)
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self.read()
+        return arr if dtype is None else arr.astype(dtype)
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        if not (isinstance(rows, slice) and isinstance(cols, slice)) or rows.step not in (None, 1) or cols.step not in (None, 1):
+            raise IndexError('Only [rows, cols] slices with step 1 are supported, use np.asarray() for other indexing.')
+        row_start, row_stop, _ = rows.indices(self.shape[0])
+        col_start, col_stop, _ = cols.indices(self.shape[1])
+        return self.read(Window(col_start, row_start, max(col_stop - col_start, 0), max(row_stop - row_start, 0)))
+
+
+def product_key(source_paths, params):
+
+    '''
+    Hash of the source files (path, size and modification time) and the derivation parameters.
+    '''
+
+    sources = []
+    for path in source_paths:
+        stat = os.stat(path)
+        sources.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+
+    key = json.dumps({'sources': sources, 'params': params}, sort_keys=True, default=str)
+
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def cleanup_cache(cache_dir=default_cache_dir, max_cache_size_mb=default_max_cache_size_mb, keep=()):
+
+    '''
+    Delete the least recently used products until the cache is smaller than max_cache_size_mb.
+    Paths in keep and products in use in this process (see LazyArray) are never deleted.
+    Temporary files of interrupted writes are deleted once they are older than stale_tmp_age.
+    '''
+
+    for f in os.listdir(cache_dir):
+        tmp_path = os.path.join(cache_dir, f)
+        if f.endswith('.tmp') and time.time() - os.path.getmtime(tmp_path) > stale_tmp_age:
+            os.remove(tmp_path)
+
+    keep = {os.path.abspath(path) for path in keep} | {os.path.abspath(lazy_array.path) for lazy_array in list(_live_arrays)}
+
+    paths = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.tif')]
+    paths.sort(key=os.path.getmtime)  # oldest (least recently used) first
+
+    total_size = sum(os.path.getsize(p) for p in paths)
+
+    for path in paths:
+        if total_size <= max_cache_size_mb * 1024**2:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        total_size -= os.path.getsize(path)
+        os.remove(path)
+
+
+def cached_product(name, source_paths, params, build, cache_dir=default_cache_dir, max_cache_size_mb=default_max_cache_size_mb):
+
+    '''
+    Return a derived product from the on-disk cache, computing and storing it first if needed.
+    name: product name (part of the file name), source_paths and params: define the cache key (see product_key).
+    build: function without arguments returning (bands, profile): bands is a dict of band name -> 2D array
+    (all of the same shape and dtype), profile optional rasterio profile entries (e.g. crs, transform).
+    Products are stored as tiled, compressed GeoTIFFs, so that windows can be read without loading the whole array,
+    and the least recently used products are deleted when the cache grows beyond max_cache_size_mb.
+    Return a dict of band name -> LazyArray, and 'profile' -> profile of the stored file.
+    '''
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f'{name}_{product_key(source_paths, params)}.tif')
+
+    try:
+        os.utime(path)  # mark as recently used
+    except FileNotFoundError:
+        _write_product(path, build)
+        cleanup_cache(cache_dir, max_cache_size_mb, keep=(path,))
+
+    try:
+        return _open_lazy_product(path)
+    except RasterioIOError:
+        if os.path.exists(path):
+            raise
+        # deleted by the cleanup of another process in the meantime, derive it again
+        _write_product(path, build)
+        return _open_lazy_product(path)
+
+
+def _write_product(path, build):
+
+    bands, profile = build()
+    band_names = list(bands)
+    first = bands[band_names[0]]
+
+    profile = dict(profile, driver='GTiff', count=len(band_names), height=first.shape[0], width=first.shape[1],
+                   dtype=first.dtype, tiled=True, blockxsize=256, blockysize=256, compress='deflate')
+
+    # write to a temporary file first, so that other workers never read an incomplete product
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', NotGeoreferencedWarning)
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            for i, band_name in enumerate(band_names, start=1):
+                dst.write(bands[band_name], i)
+                dst.set_band_description(i, band_name)
+    os.replace(tmp_path, path)
+
+
+def _open_lazy_product(path):
+
+    with _open_product(path) as src:
+        band_names = src.descriptions
+        profile = src.profile
+
+    output = {band_name: LazyArray(path, i) for i, band_name in enumerate(band_names, start=1)}
+    output['profile'] = profile
+
+    return output
@@ -0,0 +1,199 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy import ndimage
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+
+from modules.images import find_dataset_path
+
+
+# radius of the sphere with the same surface as the WGS84 ellipsoid (authalic radius), in m
+earth_radius = 6371007.2
+
+
+def _pixel_areas(transform, crs, row_off, n_rows):
+
+    '''
+    Area in m2 of the pixels of rows row_off to row_off + n_rows (one value per row).
+    For geographic CRSs the area of each row is computed on the sphere, as it shrinks towards the poles.
+    '''
+
+    if crs.is_geographic:
+        top = transform.f + transform.e * (row_off + np.arange(n_rows))
+        bottom = top + transform.e
+        return earth_radius**2 * abs(np.radians(transform.a)) * np.abs(np.sin(np.radians(top)) - np.sin(np.radians(bottom)))
+
+    return np.full(n_rows, abs(transform.a * transform.e) * crs.linear_units_factor[1]**2)
+
+
+def _label_tile(lst_path, imd_path, window, threshold, threshold_by):
+
+    '''
+    Label the connected areas above threshold in one tile of the LST raster.
+    IMD is read over the same bounds, averaged to the LST pixels.
+    Return the number of labels, per-label statistics, and the labels along the tile edges for stitching.
+    '''
+
+    with rasterio.open(lst_path) as lst_src, rasterio.open(imd_path) as imd_src:
+
+        lst_arr = lst_src.read(1, window=window, masked=True).astype(np.float32).filled(np.nan)
+        row_areas = _pixel_areas(lst_src.transform, lst_src.crs, window.row_off, lst_arr.shape[0])
+
+        imd_window = imd_src.window(*lst_src.window_bounds(window))
+        imd_arr = imd_src.read(1, window=imd_window, out_shape=lst_arr.shape, resampling=Resampling.average,
+                               boundless=True, masked=True).astype(np.float32).filled(np.nan)
+
+    if threshold_by == 'LST':
+        values = lst_arr
+    elif threshold_by == 'IMD':
+        values = imd_arr
+    else:
+        raise ValueError('Invalid threshold_by argument. Choose from "LST" or "IMD".')
+
+    # NaN compares False, so nodata is never part of a hot spot
+    labels, n_labels = ndimage.label((values >= threshold) & ~np.isnan(lst_arr))
+
+    flat_labels = labels.ravel()
+    imd_valid = ~np.isnan(imd_arr.ravel())
+    index = np.arange(1, n_labels + 1)
+
+    stats = {
+        'n_pixels': np.bincount(flat_labels, minlength=n_labels + 1)[1:],
+        'area': np.bincount(flat_labels, weights=np.repeat(row_areas, lst_arr.shape[1]), minlength=n_labels + 1)[1:],
+        'lst_sum': np.bincount(flat_labels, weights=np.nan_to_num(lst_arr.ravel()), minlength=n_labels + 1)[1:],
+        'lst_max': np.asarray(ndimage.maximum(lst_arr, labels, index), dtype=float).reshape(-1),
+        'imd_sum': np.bincount(flat_labels[imd_valid], weights=imd_arr.ravel()[imd_valid], minlength=n_labels + 1)[1:],
+        'imd_count': np.bincount(flat_labels[imd_valid], minlength=n_labels + 1)[1:],
+    }
+
+    # bounding boxes in global pixel coordinates (end exclusive)
+    slices = ndimage.find_objects(labels)
+    stats['row_min'] = np.array([s[0].start for s in slices], dtype=int) + window.row_off
+    stats['row_max'] = np.array([s[0].stop for s in slices], dtype=int) + window.row_off
+    stats['col_min'] = np.array([s[1].start for s in slices], dtype=int) + window.col_off
+    stats['col_max'] = np.array([s[1].stop for s in slices], dtype=int) + window.col_off
+
+    edges = {'top': labels[0, :], 'bottom': labels[-1, :], 'left': labels[:, 0], 'right': labels[:, -1]}
+
+    return n_labels, stats, edges
+
+
+def _find(parent, i):
+
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]  # path halving
+        i = parent[i]
+
+    return i
+
+
+def _stitch(parent, edge_a, edge_b):
+
+    '''
+    Union the (global) labels that touch across a tile border. edge_a and edge_b are the adjacent pixel lines.
+    '''
+
+    touching = (edge_a > 0) & (edge_b > 0)
+
+    for a, b in np.unique(np.stack([edge_a[touching], edge_b[touching]], axis=1), axis=0):
+        root_a, root_b = _find(parent, a), _find(parent, b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def detect_hotspots(rasters_dir, chosen_region, threshold, threshold_by='LST', tile_size=512, max_workers=4, min_pixels=1,
+                    lst_path=None, imd_path=None):
+
+    '''
+    Detect hot spots: connected areas (4-connectivity) of LST pixels with threshold_by ('LST' or 'IMD') >= threshold.
+    The LST raster is labelled tile by tile in parallel, and labels of areas crossing tile borders are merged
+    with union-find, so only tiles of tile_size x tile_size pixels are held in memory.
+    IMD is averaged to the LST pixels.
+    min_pixels: smallest area (in LST pixels) to report.
+    lst_path, imd_path: rasters to use instead of those of the chosen region, e.g. the national rasters
+    (find_national_path('datasets', 'LST')); both must have the same CRS.
+    Return a list of hot spots (largest first), each a dict with the area (in m2), number of pixels,
+    mean and max LST, mean IMD, bounds (left, bottom, right, top) in the CRS of the raster,
+    and bounds_latlon ([[bottom, left], [top, right]], as in read_image).
+    '''
+
+    if lst_path is None:
+        lst_path = find_dataset_path(rasters_dir, chosen_region, 'LST')
+    if imd_path is None:
+        imd_path = find_dataset_path(rasters_dir, chosen_region, 'IMD')
+
+    with rasterio.open(lst_path) as src, rasterio.open(imd_path) as imd_src:
+        height, width, transform, crs = src.height, src.width, src.transform, src.crs
+        if imd_src.crs != crs:
+            raise ValueError(f'LST and IMD must have the same CRS ({lst_path}: {crs}, {imd_path}: {imd_src.crs}).')
+
+    tile_rows = list(range(0, height, tile_size))
+    tile_cols = list(range(0, width, tile_size))
+    windows = [Window(col_off, row_off, min(tile_size, width - col_off), min(tile_size, height - row_off))
+               for row_off in tile_rows for col_off in tile_cols]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tiles = list(executor.map(lambda w: _label_tile(lst_path, imd_path, w, threshold, threshold_by), windows))
+
+    # global label = local label + offset of the tile (0 stays background)
+    offsets = np.cumsum([0] + [n_labels for n_labels, _, _ in tiles])
+    parent = np.arange(offsets[-1] + 1)
+
+    def global_edge(t, side):
+        edge = tiles[t][2][side]
+        return np.where(edge > 0, edge + offsets[t], 0)
+
+    n_cols = len(tile_cols)
+    for t in range(len(tiles)):
+        if (t + 1) % n_cols != 0:
+            _stitch(parent, global_edge(t, 'right'), global_edge(t + 1, 'left'))
+        if t + n_cols < len(tiles):
+            _stitch(parent, global_edge(t, 'bottom'), global_edge(t + n_cols, 'top'))
+
+    if offsets[-1] == 0:
+        return []
+
+    # merge the per-label statistics by cluster
+    roots = np.array([_find(parent, i) for i in range(1, offsets[-1] + 1)])
+    _, cluster = np.unique(roots, return_inverse=True)
+    n_clusters = cluster.max() + 1
+
+    merged = {key: np.concatenate([stats[key] for _, stats, _ in tiles]) for key in tiles[0][1]}
+
+    def merge(key, ufunc, initial):
+        out = np.full(n_clusters, initial, dtype=merged[key].dtype)
+        ufunc.at(out, cluster, merged[key])
+        return out
+
+    n_pixels = np.bincount(cluster, weights=merged['n_pixels'], minlength=n_clusters)
+    area = np.bincount(cluster, weights=merged['area'], minlength=n_clusters)
+    lst_sum = np.bincount(cluster, weights=merged['lst_sum'], minlength=n_clusters)
+    imd_sum = np.bincount(cluster, weights=merged['imd_sum'], minlength=n_clusters)
+    imd_count = np.bincount(cluster, weights=merged['imd_count'], minlength=n_clusters)
+    lst_max = merge('lst_max', np.fmax, -np.inf)
+    row_min, col_min = merge('row_min', np.minimum, height), merge('col_min', np.minimum, width)
+    row_max, col_max = merge('row_max', np.maximum, 0), merge('col_max', np.maximum, 0)
+
+    hotspots = []
+    for c in np.argsort(-n_pixels, kind='stable'):
+
+        if n_pixels[c] < min_pixels:
+            continue
+
+        left, top = transform * (col_min[c], row_min[c])
+        right, bottom = transform * (col_max[c], row_max[c])
+        min_lon, min_lat, max_lon, max_lat = transform_bounds(crs, 'EPSG:4326', left, bottom, right, top)
+
+        hotspots.append({
+            'area': float(area[c]),
+            'n_pixels': int(n_pixels[c]),
+            'mean_lst': float(lst_sum[c] / n_pixels[c]),
+            'max_lst': float(lst_max[c]),
+            'mean_imd': float(imd_sum[c] / imd_count[c]) if imd_count[c] > 0 else np.nan,
+            'bounds': (float(left), float(bottom), float(right), float(top)),
+            'bounds_latlon': [[min_lat, min_lon], [max_lat, max_lon]],
+        })
+
+    return hotspots
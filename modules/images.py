@@ -1,4 +1,18 @@
+import os
+import json
+import math
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 import rasterio
+from affine import Affine
+from rasterio.coords import BoundingBox
+from rasterio.enums import Resampling
+from rasterio.errors import WindowError
+from rasterio.features import geometry_mask, bounds as features_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform, transform_bounds, transform_geom
+from rasterio.windows import Window, from_bounds
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import Normalize
@@ -53,42 +67,230 @@ def visualize_datasets(dataset_properties, figure_size=(12, 6)):
 
 
 
-def read_image(rasters_dir, chosen_region, dataset_label, mask_below=None):    
+# projection of the master rasters, all other projections are derived on the fly in read_image
+master_projection = '3035'
+
+
+def find_dataset_path(rasters_dir, chosen_region, dataset_label, target_projection=master_projection, fallback_projection='4326'):
     '''
-    Read LSM and IMD images for the chosen region.
-    Return arrays, bounds, min and max values for both images.
+    Return the path to the dataset_label raster of the chosen region in target_projection.
+    If there is no such raster, the copy in fallback_projection is returned instead
+    (for regions prepared before the rasters were kept in the master projection only).
     '''
 
     image_label = regions_dict[chosen_region][3]
-    target_projection = '4326' #'3857'
 
-    path_to_dataset = list_filepaths(rasters_dir, [dataset_label, image_label,  '.tif', target_projection], ['.aux'])[0]
+    paths = list_filepaths(rasters_dir, [dataset_label, image_label,  '.tif', target_projection], ['.aux'], print_warning=False)
+    
+    if not paths and fallback_projection:
+        paths = list_filepaths(rasters_dir, [dataset_label, image_label,  '.tif', fallback_projection], ['.aux'])
+
+    return paths[0]
+
+
+def find_national_path(datasets_dir, dataset_label, target_projection=master_projection):
+    '''
+    Return the path to the national (not clipped) dataset_label raster in target_projection.
+    '''
+
+    return list_filepaths(datasets_dir, [dataset_label, '.tif', target_projection], ['.aux'])[0]
+
+
+@lru_cache(maxsize=8)
+def load_region_geometry(path_to_shapefile):
+    '''
+    Read all polygons of a region shapefile.
+    Return a tuple of GeoJSON-like geometries and the WKT of their CRS.
+    '''
+
+    from osgeo import ogr
+
+    source_ds = ogr.Open(path_to_shapefile)
+    source_layer = source_ds.GetLayer()
+    geometries = tuple(json.loads(feature.GetGeometryRef().ExportToJson()) for feature in source_layer)
+    source_crs = source_layer.GetSpatialRef().ExportToWkt()
+    source_ds = None
+
+    return geometries, source_crs
+
+
+@lru_cache(maxsize=16)
+def _region_mask(path_to_shapefile, target_crs, transform, shape):
+    '''
+    Rasterize the region polygons to the grid given by transform and shape.
+    Return a read-only boolean array, True outside the region.
+    '''
+
+    geometries, source_crs = load_region_geometry(path_to_shapefile)
+    geometries = [transform_geom(source_crs, target_crs, geom) for geom in geometries]
+
+    mask = geometry_mask(geometries, out_shape=shape, transform=transform)
+    mask.flags.writeable = False
+
+    return mask
+
+
+def region_bounds(path_to_shapefile, target_crs):
+    '''
+    Bounds (left, bottom, right, top) of the region polygons in target_crs.
+    '''
+
+    geometries, source_crs = load_region_geometry(path_to_shapefile)
+    all_bounds = np.array([features_bounds(transform_geom(source_crs, target_crs, geom)) for geom in geometries])
+
+    return all_bounds[:, 0].min(), all_bounds[:, 1].min(), all_bounds[:, 2].max(), all_bounds[:, 3].max()
+
+
+def resolve_dataset_path(rasters_dir, chosen_region, dataset_label, shapefiles_dir=None, bbox=None):
+    '''
+    Path of the raster read_image reads: the national raster if the region is read on demand
+    (shapefiles_dir or bbox given, see read_image), else the raster of the chosen region (see find_dataset_path).
+    '''
+
+    if bbox is not None or shapefiles_dir is not None:
+        return find_national_path(rasters_dir, dataset_label)
+
+    return find_dataset_path(rasters_dir, chosen_region, dataset_label)
+
+
+# memory budget of the cache of warped reads (see _read_warped_cached), in MB
+warped_cache_size_mb = 1024
+
+_warped_cache = OrderedDict()
+_warped_cache_lock = threading.Lock()
+
+
+def _read_warped(path_to_dataset, modified_time, target_crs, resolution, resampling, bounds=None, decimation=1, grid=None):
+    '''
+    Read band 1 of path_to_dataset reprojected to target_crs (at resolution, in target_crs units, if given)
+    through a warped virtual dataset, i.e. in memory without writing a reprojected copy.
+    bounds: if given (left, bottom, right, top in target_crs), only the window covering them is read,
+    so only the intersecting blocks of the source raster are accessed.
+    decimation: if > 1, only every decimation-th pixel in both directions is read (from overviews, if the raster has them).
+    grid: if given (transform, width, height in target_crs), the raster is warped onto exactly this grid
+    (resolution and bounds are then ignored).
+    modified_time is only part of the cache key, so that changed files are read again.
+    Return a float32 array (NaN as nodata), its bounds, transform and the CRS string.
+    '''
+
+    with rasterio.open(path_to_dataset) as src:
+
+        vrt_options = {'crs': target_crs, 'resampling': Resampling[resampling]}
+
+        if grid is not None:
+            transform, width, height = grid
+            vrt_options.update({'transform': transform, 'width': width, 'height': height})
+            bounds = None
+        elif resolution is not None:
+            transform, width, height = calculate_default_transform(src.crs, target_crs, src.width, src.height,
+                                                                   *src.bounds, resolution=resolution)
+            vrt_options.update({'transform': transform, 'width': width, 'height': height})
+
+        with WarpedVRT(src, **vrt_options) as vrt:
+
+            if bounds is None:
+                window = Window(0, 0, vrt.width, vrt.height)
+            else:
+                # snap the window outwards to whole pixels, and keep it within the raster
+                window = from_bounds(*bounds, transform=vrt.transform)
+                col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+                window = Window(col_off, row_off,
+                                math.ceil(window.col_off + window.width) - col_off,
+                                math.ceil(window.row_off + window.height) - row_off)
+                window = window.intersection(Window(0, 0, vrt.width, vrt.height))
+
+            out_shape = (math.ceil(window.height / decimation), math.ceil(window.width / decimation))
+            arr = vrt.read(1, window=window, out_shape=out_shape, masked=True).astype(np.float32).filled(np.nan)
+            window_bounds = BoundingBox(*vrt.window_bounds(window))
+            window_transform = vrt.window_transform(window) * Affine.scale(window.width / out_shape[1], window.height / out_shape[0])
+            vrt_crs = vrt.crs.to_string().upper()
+
+    return arr, window_bounds, window_transform, vrt_crs
+
+
+def _read_warped_cached(*args):
+    '''
+    _read_warped with a least recently used cache limited to warped_cache_size_mb.
+    Reads larger than the budget (e.g. whole national rasters) are not cached and returned writable;
+    cached arrays are read-only, since they are shared between calls.
+    '''
+
+    with _warped_cache_lock:
+        if args in _warped_cache:
+            _warped_cache.move_to_end(args)
+            return _warped_cache[args]
+
+    output = _read_warped(*args)
+    arr = output[0]
+    budget = warped_cache_size_mb * 1024**2
+
+    if arr.nbytes <= budget:
+        arr.flags.writeable = False
+        with _warped_cache_lock:
+            _warped_cache[args] = output
+            total = sum(cached[0].nbytes for cached in _warped_cache.values())
+            while total > budget:
+                _, evicted = _warped_cache.popitem(last=False)
+                total -= evicted[0].nbytes
+
+    return output
+
+
+def read_image(rasters_dir, chosen_region, dataset_label, mask_below=None, target_crs='EPSG:4326', resolution=None, resampling='nearest',
+               shapefiles_dir=None, bbox=None, bbox_crs='EPSG:4326', decimation=1, reference_grid=None):    
+    '''
+    Read LSM and IMD images for the chosen region.
+    The master raster (see find_dataset_path) is reprojected in memory to target_crs;
+    resolution (in target_crs units) optionally sets the output resolution, resampling the GDAL resampling method.
+    The last reads are cached up to warped_cache_size_mb (MB), so repeated calls with the same arguments
+    do not warp again; larger reads are never cached.
+    
+    Regions can also be read on demand from the national rasters, without clipped region files.
+    In that case rasters_dir is the directory of the national rasters (see find_national_path) and either
+    - shapefiles_dir: directory with the region shapefile (regions_dict[chosen_region][2]).
+      Only the window covering the region is read and pixels outside the polygons are set to NaN.
+    - bbox: (left, bottom, right, top) in bbox_crs. Only the window covering the bbox is read.
+    decimation: if > 1, only every decimation-th pixel in both directions is read (e.g. for quick previews).
+    reference_grid: (transform, width, height) in target_crs to warp onto, e.g. to align a dataset pixel by pixel
+    with another one (see the 'transform' of the output).
+    Return arrays, bounds, transform, min and max values for both images.
+    '''
+
+    path_to_dataset = resolve_dataset_path(rasters_dir, chosen_region, dataset_label, shapefiles_dir, bbox)
+    path_to_shapefile = None
+    read_bounds = None
+
+    if bbox is not None:
+        read_bounds = tuple(transform_bounds(bbox_crs, target_crs, *bbox))
+    elif shapefiles_dir is not None:
+        path_to_shapefile = os.path.join(shapefiles_dir, regions_dict[chosen_region][2])
+        read_bounds = region_bounds(path_to_shapefile, target_crs)
 
     # print(path_to_dataset)
     
-    with rasterio.open(path_to_dataset) as src:
-        
-        arr = src.read(1).astype(np.float32)
-        
-        arr[arr == src.nodata] = np.nan
-        
-        # src_crs = src.crs['init'].upper()
-        
-        # Updated line to access CRS information
-        src_crs = src.crs.to_string().upper()
+    try:
+        cached_arr, bounds, transform, src_crs = _read_warped_cached(path_to_dataset, os.path.getmtime(path_to_dataset), target_crs,
+                                                                     resolution, resampling, read_bounds, decimation, reference_grid)
+    except WindowError:
+        area = f'bbox {bbox}' if bbox is not None else f'region {chosen_region}'
+        raise ValueError(f'The {area} does not overlap {path_to_dataset}.') from None
+    
+    # copy cached arrays, since the array is modified by the callers (uncached reads are not shared)
+    arr = cached_arr.copy() if not cached_arr.flags.writeable else cached_arr
 
+    if path_to_shapefile is not None:
+        arr[_region_mask(path_to_shapefile, target_crs, transform, arr.shape)] = np.nan
 
-        min_lon, min_lat, max_lon, max_lat = src.bounds
-        bounds_lst = [[src.bounds.bottom, src.bounds.left], [src.bounds.top, src.bounds.right]]
-        
-        arr_min = np.nanmin(arr)
-        arr_max = np.nanmax(arr)
-        
-        if mask_below is not None:
-            mask = np.where(arr<mask_below)
-            arr[mask] = np.nan
+    bounds_lst = [[bounds.bottom, bounds.left], [bounds.top, bounds.right]]
+    
+    arr_min = np.nanmin(arr)
+    arr_max = np.nanmax(arr)
+    
+    if mask_below is not None:
+        mask = np.where(arr<mask_below)
+        arr[mask] = np.nan
         
-    output_dict = {'array': arr, 'bounds': bounds_lst, 'min_value': arr_min, 'max_value': arr_max, 'crs': src_crs}
+    output_dict = {'array': arr, 'bounds': bounds_lst, 'min_value': arr_min, 'max_value': arr_max, 'crs': src_crs, 'transform': transform}
     
     if mask_below is not None:
         output_dict['mask'] = mask
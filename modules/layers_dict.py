@@ -0,0 +1,6 @@
+# label: file name pattern, display name, resampling used when the layer is brought to a finer or coarser grid
+layers_dict = {"IMD": {'pattern': 'IMD', 'name': 'Imperviousness Density (%)', 'resampling': 'bilinear'},
+               "LST": {'pattern': 'LST', 'name': 'Land Surface Temperature (°C)', 'resampling': 'nearest'},
+               "TCD": {'pattern': 'TCD', 'name': 'Tree Cover Density (%)', 'resampling': 'bilinear'},
+               "WAW": {'pattern': 'WAW', 'name': 'Water and Wetness', 'resampling': 'nearest'}
+}
@@ -0,0 +1,141 @@
+from contextlib import ExitStack
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+from modules.images import find_dataset_path
+from modules.layers_dict import layers_dict
+
+
+def iter_joint_windows(rasters_dir, chosen_region, labels, reference=None, block_rows=64, scaling_factor=1, paths=None):
+
+    '''
+    Iterate over co-registered windows of several layers (labels from layers_dict) of the chosen region.
+    All rasters are opened once; the grid of the reference layer (default: the finest one), refined by
+    scaling_factor, is the common grid, and each layer is read for the same bounds, directly resampled
+    to the reference strip with the resampling of layers_dict. Layers in another CRS than the reference
+    are read through a WarpedVRT on the reference grid.
+    paths: dict of label -> raster path, to use instead of those of the chosen region (e.g. the national rasters).
+    Yields dicts of label -> float32 block (NaN as nodata), one strip of block_rows reference rows
+    (block_rows * scaling_factor rows of the common grid) at a time.
+    '''
+
+    paths = dict(paths or {})
+    for label in labels:
+        if label not in paths:
+            paths[label] = find_dataset_path(rasters_dir, chosen_region, layers_dict[label]['pattern'])
+
+    with ExitStack() as stack:
+        sources = {label: stack.enter_context(rasterio.open(paths[label])) for label in labels}
+
+        if reference is None:
+            reference = min(labels, key=lambda label: _pixel_area(sources[label], sources[labels[0]].crs))
+        ref_src = sources[reference]
+
+        # layers in another CRS are warped on the fly onto the refined reference grid (a WarpedVRT cannot be read boundless)
+        grid_transform = ref_src.transform * Affine.scale(1 / scaling_factor)
+        warped = {label: stack.enter_context(WarpedVRT(src, crs=ref_src.crs, transform=grid_transform,
+                                                       width=ref_src.width * scaling_factor, height=ref_src.height * scaling_factor,
+                                                       resampling=Resampling[layers_dict[label]['resampling']]))
+                  for label, src in sources.items() if src.crs != ref_src.crs}
+
+        for row_off in range(0, ref_src.height, block_rows):
+
+            ref_window = Window(0, row_off, ref_src.width, min(block_rows, ref_src.height - row_off))
+            ref_bounds = ref_src.window_bounds(ref_window)
+            out_shape = (int(ref_window.height) * scaling_factor, int(ref_window.width) * scaling_factor)
+
+            blocks = {}
+            for label, src in sources.items():
+                if label in warped:
+                    block = warped[label].read(1, window=Window(0, row_off * scaling_factor, out_shape[1], out_shape[0]), masked=True)
+                else:
+                    block = src.read(1, window=src.window(*ref_bounds), out_shape=out_shape,
+                                     resampling=Resampling[layers_dict[label]['resampling']], boundless=True, masked=True)
+                blocks[label] = block.astype(np.float32).filled(np.nan)
+
+            yield blocks
+
+
+def _pixel_area(src, crs):
+
+    '''
+    Pixel area of src in the units of crs (to compare the resolutions of rasters in different CRSs).
+    '''
+
+    if src.crs == crs:
+        return abs(src.res[0] * src.res[1])
+
+    with WarpedVRT(src, crs=crs) as vrt:
+        return abs(vrt.res[0] * vrt.res[1])
+
+
+def joint_statistics(rasters_dir, chosen_region, labels, class_label=None, n_classes=101, mask=None, reference=None, block_rows=64):
+
+    '''
+    Statistics of several layers in a single pass over co-registered windows (see iter_joint_windows).
+    Only pixels where all layers have data (and, if given, mask is True) are used.
+    mask: function of a dict of label -> block returning a boolean block, e.g. lambda b: (b['IMD'] > 50) & (b['TCD'] < 10)
+    class_label: if given, the mean of every layer is also computed per class of this layer
+    (values truncated to integers 0 to n_classes-1, e.g. the IMD classes).
+    Return a dict with 'labels', 'n_pixels', 'mean' (label -> mean), 'correlation' (matrix in the order of labels)
+    and, with class_label, 'class_counts' and 'class_means' (label -> mean per class, NaN for empty classes).
+    '''
+
+    labels = list(labels)
+    n_layers = len(labels)
+
+    n_pixels = 0
+    shift = None  # first block means, subtracted for numerically stable sums
+    sums = np.zeros(n_layers)
+    cross_products = np.zeros((n_layers, n_layers))
+    class_counts = np.zeros(n_classes)
+    class_sums = np.zeros((n_layers, n_classes))
+
+    for blocks in iter_joint_windows(rasters_dir, chosen_region, labels, reference, block_rows):
+
+        valid = np.all([~np.isnan(blocks[label]) for label in labels], axis=0)
+        if mask is not None:
+            valid &= mask(blocks)
+
+        values = np.stack([blocks[label][valid] for label in labels]).astype(float)  # layers x pixels
+        if values.shape[1] == 0:
+            continue
+
+        if shift is None:
+            shift = values.mean(axis=1)
+        centered = values - shift[:, None]
+
+        n_pixels += values.shape[1]
+        sums += centered.sum(axis=1)
+        cross_products += centered @ centered.T
+
+        if class_label is not None:
+            classes = values[labels.index(class_label)].astype(int)
+            in_range = (classes >= 0) & (classes < n_classes)
+            class_counts += np.bincount(classes[in_range], minlength=n_classes)
+            for i in range(n_layers):
+                class_sums[i] += np.bincount(classes[in_range], weights=values[i, in_range], minlength=n_classes)
+
+    output = {'labels': labels, 'n_pixels': n_pixels}
+
+    if n_pixels == 0:
+        print('Warning! No pixels with data in all layers found for the chosen region.')
+        return output
+
+    mean_centered = sums / n_pixels
+    covariance = (cross_products - n_pixels * np.outer(mean_centered, mean_centered)) / max(n_pixels - 1, 1)
+    std = np.sqrt(np.diag(covariance))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        output['mean'] = dict(zip(labels, shift + mean_centered))
+        output['correlation'] = covariance / np.outer(std, std)
+
+        if class_label is not None:
+            output['class_counts'] = class_counts
+            output['class_means'] = {label: class_sums[i] / class_counts for i, label in enumerate(labels)}
+
+    return output
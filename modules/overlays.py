@@ -0,0 +1,302 @@
+import io
+import math
+import base64
+import numpy as np
+import matplotlib.pyplot as plt
+from PIL import Image
+from branca.element import MacroElement
+from folium.raster_layers import ImageOverlay
+from folium.template import Template
+
+
+# colormaps offered by the client-side controls
+client_colormaps = ['Spectral_r', 'Reds', 'Greys', 'viridis', 'magma', 'coolwarm']
+
+
+# tolerance (in codes) for floating point errors of values and thresholds on code boundaries
+code_tolerance = 1e-9
+
+
+def code_grid(arr, value_range, anchor=None):
+    '''
+    Values of the codes: return the value_range (value_range[0] is the value of code 1) and the step between two codes.
+    Integers spanning at most 255 values (e.g. the IMD classes 0-100) get step 1, so that they are encoded without loss.
+    Other values get 253 steps over value_range; if anchor (e.g. the mask threshold) is given, the codes are shifted
+    (by less than one step) so that anchor is a code boundary, i.e. value < anchor can be told from the codes alone.
+    '''
+
+    vmin, vmax = value_range
+    values = arr[~np.isnan(arr)]
+
+    if vmax <= vmin or (vmax - vmin <= 254 and float(vmin).is_integer() and np.all(values == np.floor(values))):
+        return (vmin, vmax), 1.0
+
+    step = (vmax - vmin) / 253
+    if anchor is not None and vmin <= anchor <= vmax:
+        vmin = anchor - math.ceil((anchor - vmin) / step - code_tolerance) * step
+
+    return (vmin, vmax), step
+
+
+def encode_values(arr, value_range, step):
+    '''
+    Quantize arr to codes 1-255, code = 1 + number of whole steps above value_range[0] (code 0 = NaN / nodata),
+    and return it as a grayscale PNG data URL.
+    value < threshold is then code < 1 + ceil((threshold - value_range[0]) / step), as in the browser
+    (see ClientSideMaskControl), exactly if the threshold is a code boundary.
+    '''
+
+    vmin, vmax = value_range
+    scaled = (np.clip(arr.astype(np.float64), vmin, vmax) - vmin) / step
+    codes = np.where(np.isnan(arr), 0, 1 + np.clip(np.floor(np.nan_to_num(scaled) + code_tolerance), 0, 254)).astype(np.uint8)
+
+    buffer = io.BytesIO()
+    Image.fromarray(codes, mode='L').save(buffer, format='PNG', optimize=True)
+
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def colormap_lut(color_code):
+    '''
+    256 RGB colors (0-255) of a matplotlib colormap.
+    '''
+
+    return (plt.get_cmap(color_code)(np.linspace(0, 1, 256))[:, :3] * 255).round().astype(int).tolist()
+
+
+class ValueEncodedImageOverlay(ImageOverlay):
+    '''
+    Image overlay that ships the quantized values (see encode_values) instead of colors.
+    Colormap, clim and masking are applied in the browser on a canvas shown in place of the image, so they can be
+    changed without Python (see ClientSideMaskControl). Without a control, the layer is shown with color_code and clim.
+    anchor: value that is a code boundary, e.g. the initial mask threshold (see code_grid).
+    '''
+
+    _template = Template(
+        """
+        {% macro header(this, kwargs) %}
+            {% if this.pixelated %}
+                <style>
+                    .leaflet-image-layer {
+                        image-rendering: -webkit-optimize-contrast;
+                        image-rendering: crisp-edges;
+                        image-rendering: pixelated;
+                        image-rendering: -moz-crisp-edges;
+                        -ms-interpolation-mode: nearest-neighbor;
+                    }
+                </style>
+            {% endif %}
+        {% endmacro %}
+
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.imageOverlay(
+                {{ this.url|tojson }},
+                {{ this.bounds|tojson }},
+                {{ this.options|tojavascript }}
+            );
+            {{ this.get_name() }}.encoding = {{ this.encoding|tojson }};
+
+            // show a canvas instead of the image (the url only holds the value codes), so that restyle draws directly
+            // into the map without encoding an image (as Leaflet's _initImage, with the canvas as element)
+            {{ this.get_name() }}._canvas = document.createElement('canvas');
+            {{ this.get_name() }}._initImage = function() {
+                var canvas = this._image = this._canvas;
+                L.DomUtil.addClass(canvas, 'leaflet-image-layer');
+                if (this._zoomAnimated) { L.DomUtil.addClass(canvas, 'leaflet-zoom-animated'); }
+                if (this.options.className) { L.DomUtil.addClass(canvas, this.options.className); }
+                canvas.onselectstart = L.Util.falseFn;
+                canvas.onmousemove = L.Util.falseFn;
+                if (this.options.zIndex) { this._updateZIndex(); }
+            };
+            {{ this.get_name() }}._generation = 0;
+
+            // decode the value codes once
+            {{ this.get_name() }}.decoded = new Promise(function(resolve) {
+                var img = new Image();
+                img.onload = function() {
+                    var canvas = document.createElement('canvas');
+                    canvas.width = img.width;
+                    canvas.height = img.height;
+                    var ctx = canvas.getContext('2d');
+                    ctx.drawImage(img, 0, 0);
+                    var rgba = ctx.getImageData(0, 0, img.width, img.height).data;
+                    var codes = new Uint8Array(img.width * img.height);
+                    for (var i = 0; i < codes.length; i++) { codes[i] = rgba[4 * i]; }
+                    resolve({codes: codes, width: img.width, height: img.height});
+                };
+                img.src = {{ this.url|tojson }};
+            });
+
+            // value of a code (1-255), the lower boundary of its step
+            {{ this.get_name() }}.codeValue = function(code) {
+                return this.encoding.value_range[0] + (code - 1) * this.encoding.step;
+            };
+
+            // lowest code of the values >= threshold (see encode_values), not clipped to 1-255
+            {{ this.get_name() }}.thresholdCode = function(threshold) {
+                return 1 + Math.ceil((threshold - this.encoding.value_range[0]) / this.encoding.step - this.encoding.code_tolerance);
+            };
+
+            // color the decoded values with lut (256 RGB colors) and clim.
+            // mask: null, or {hide, codes, width, height} of the mask layer (hide: 1 for the codes to hide),
+            // which may have another resolution than this layer but must cover the same bounds.
+            {{ this.get_name() }}.restyle = function(lut, clim, mask) {
+                var layer = this;
+                var generation = ++this._generation;
+                return this.decoded.then(function(decoded) {
+                    // a later restyle was requested in the meantime
+                    if (generation !== layer._generation) { return; }
+
+                    var width = decoded.width, height = decoded.height, codes = decoded.codes;
+
+                    // RGBA of each code as one 32 bit value (code 0 = nodata stays transparent)
+                    var table = new Uint32Array(256);
+                    var tableBytes = new Uint8Array(table.buffer);
+                    for (var code = 1; code < 256; code++) {
+                        var position = (layer.codeValue(code) - clim[0]) / (clim[1] - clim[0]);
+                        var color = lut[Math.round(Math.min(Math.max(position, 0), 1) * 255)];
+                        tableBytes[4 * code] = color[0];
+                        tableBytes[4 * code + 1] = color[1];
+                        tableBytes[4 * code + 2] = color[2];
+                        tableBytes[4 * code + 3] = 255;
+                    }
+
+                    if (layer._canvas.width !== width || layer._canvas.height !== height) {
+                        layer._canvas.width = width;
+                        layer._canvas.height = height;
+                    }
+                    var ctx = layer._canvas.getContext('2d');
+                    var out = ctx.createImageData(width, height);
+                    var pixels = new Uint32Array(out.data.buffer);
+
+                    if (!mask) {
+                        for (var i = 0; i < codes.length; i++) { pixels[i] = table[codes[i]]; }
+                    } else {
+                        // mask pixel under the center of each row / column of this layer
+                        var maskRows = new Uint32Array(height), maskCols = new Uint32Array(width);
+                        for (var r = 0; r < height; r++) { maskRows[r] = Math.floor((r + 0.5) * mask.height / height) * mask.width; }
+                        for (var c = 0; c < width; c++) { maskCols[c] = Math.floor((c + 0.5) * mask.width / width); }
+                        var hide = mask.hide, maskCodes = mask.codes;
+                        for (var r = 0, i = 0; r < height; r++) {
+                            var maskRow = maskRows[r];
+                            for (var c = 0; c < width; c++, i++) {
+                                pixels[i] = hide[maskCodes[maskRow + maskCols[c]]] ? 0 : table[codes[i]];
+                            }
+                        }
+                    }
+                    ctx.putImageData(out, 0, 0);
+                });
+            };
+
+            {{ this.get_name() }}.restyle({{ this.encoding.lut|tojson }}, {{ this.encoding.clim|tojson }}, null);
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, arr, bounds, color_code='viridis', clim=None, value_range=None, anchor=None, **kwargs):
+
+        if value_range is None:
+            value_range = (float(np.nanmin(arr)), float(np.nanmax(arr)))
+        if clim is None:
+            clim = value_range
+        value_range, step = code_grid(arr, value_range, anchor)
+
+        super().__init__(encode_values(arr, value_range, step), bounds, **kwargs)
+        self._name = 'ValueEncodedImageOverlay'
+
+        self.encoding = {'value_range': [float(v) for v in value_range], 'step': float(step), 'code_tolerance': code_tolerance,
+                         'color_code': color_code, 'clim': [float(v) for v in clim], 'lut': colormap_lut(color_code)}
+
+
+class ClientSideMaskControl(MacroElement):
+    '''
+    Map control to change the mask threshold, colormaps and clim of ValueEncodedImageOverlay layers in the browser.
+    Pixels where mask_layer is below the threshold (or has no data) are hidden in all layers,
+    so all layers must cover the same bounds as mask_layer (they may have another resolution,
+    each pixel is masked by the mask_layer pixel under its center).
+    The threshold is compared as a code (see encode_values), so the mask matches value < threshold exactly
+    for layers encoded without loss and for thresholds on code boundaries, i.e. on the slider steps
+    if the mask layer is anchored at the initial threshold (see code_grid), else up to one step.
+    '''
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+        (function() {
+            var map = {{ this._parent.get_name() }};
+            var maskLayer = {{ this.mask_layer.get_name() }};
+            var layers = [{% for layer in this.layers %}{{ layer.get_name() }}{{ ', ' if not loop.last }}{% endfor %}];
+            var names = {{ this.layer_names|tojson }};
+            var luts = {{ this.luts|tojson }};
+            var range = maskLayer.encoding.value_range;
+
+            var control = L.control({position: 'topright'});
+            control.onAdd = function() {
+                var div = L.DomUtil.create('div', 'leaflet-bar');
+                div.style.background = 'white';
+                div.style.padding = '6px';
+                var html = 'Mask below: <span class="threshold-value"></span><br>'
+                    + '<input class="threshold" type="range" min="' + range[0] + '" max="' + range[1]
+                    + '" step="' + maskLayer.encoding.step + '" value="{{ this.threshold }}" style="width: 100%">';
+                layers.forEach(function(layer, i) {
+                    html += '<br><b>' + names[i] + '</b><br><select class="cmap-' + i + '">';
+                    Object.keys(luts).forEach(function(name) {
+                        var selected = name === layer.encoding.color_code ? ' selected' : '';
+                        html += '<option value="' + name + '"' + selected + '>' + name + '</option>';
+                    });
+                    html += '</select> <input class="clim-min-' + i + '" type="number" step="any" style="width: 4em" value="' + layer.encoding.clim[0] + '">'
+                        + ' - <input class="clim-max-' + i + '" type="number" step="any" style="width: 4em" value="' + layer.encoding.clim[1] + '">';
+                });
+                div.innerHTML = html;
+                L.DomEvent.disableClickPropagation(div);
+                L.DomEvent.disableScrollPropagation(div);
+                div.addEventListener('input', function() { scheduleUpdate(div); });
+                setTimeout(function() { update(div); }, 0);
+                return div;
+            };
+
+            // at most one update per animation frame, however fast the slider moves
+            var updatePending = false;
+            function scheduleUpdate(div) {
+                if (updatePending) { return; }
+                updatePending = true;
+                requestAnimationFrame(function() {
+                    updatePending = false;
+                    update(div);
+                });
+            }
+
+            function update(div) {
+                var threshold = parseFloat(div.querySelector('.threshold').value);
+                div.querySelector('.threshold-value').textContent = threshold.toFixed(2);
+                maskLayer.decoded.then(function(decoded) {
+                    // compare codes, not decoded values, so that the threshold is quantized like the data
+                    var thresholdCode = maskLayer.thresholdCode(threshold);
+                    var hide = new Uint8Array(256);
+                    hide[0] = 1;
+                    for (var code = 1; code < 256; code++) { hide[code] = code < thresholdCode ? 1 : 0; }
+                    var mask = {hide: hide, codes: decoded.codes, width: decoded.width, height: decoded.height};
+                    layers.forEach(function(layer, i) {
+                        var clim = [parseFloat(div.querySelector('.clim-min-' + i).value),
+                                    parseFloat(div.querySelector('.clim-max-' + i).value)];
+                        layer.restyle(luts[div.querySelector('.cmap-' + i).value], clim, mask);
+                    });
+                });
+            }
+
+            control.addTo(map);
+        })();
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, layers, mask_layer, threshold, colormaps=client_colormaps):
+
+        super().__init__()
+        self._name = 'ClientSideMaskControl'
+
+        self.layers = layers
+        self.mask_layer = mask_layer
+        self.threshold = float(threshold)
+        self.layer_names = [layer.layer_name for layer in layers]
+        self.luts = {name: colormap_lut(name) for name in dict.fromkeys(list(colormaps) + [l.encoding['color_code'] for l in layers])}